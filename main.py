@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 # main.py — Dota2 Telegram Tracker Bot (single-file, aiogram v3)
-# Требует: aiogram>=3.0, aiohttp, matplotlib
+# Требует: aiogram>=3.0, aiohttp, matplotlib, numpy, Pillow (опционально orjson — быстрее парсит ответы OpenDota)
 # Запуск: export BOT_TOKEN=... && python main.py
 
 import os
@@ -8,24 +8,36 @@ import re
 import json
 import time
 import math
+import random
 import sqlite3
 import logging
 import aiohttp
 import asyncio
-import tempfile
-from contextlib import closing
+import threading
+import io
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from functools import lru_cache
 from datetime import datetime, timedelta, timezone
-from typing import Optional, Dict, Any, List, Tuple
+from typing import Optional, Dict, Any, List, Tuple, Iterable
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 # aiogram v3
 from aiogram import Bot, Dispatcher, F
-from aiogram.types import Message, CallbackQuery, FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import Message, CallbackQuery, BufferedInputFile, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.filters import Command
+from aiogram.exceptions import TelegramRetryAfter
 
-# matplotlib (аггрегируем png)
+# графики рисуем напрямую через Pillow; matplotlib нужен ради DejaVuSans (кириллица),
+# numpy и Pillow приходят вместе с ним
 import matplotlib
-matplotlib.use("Agg")
-import matplotlib.pyplot as plt
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
 
 # ---------------- CONFIG ----------------
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -35,14 +47,24 @@ if not BOT_TOKEN:
 OPEN_DOTA = "https://api.opendota.com/api"
 DB_PATH = os.getenv("DB_PATH", "dota_bot.db")
 POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", "60"))     # seconds
+POLL_CONCURRENCY = int(os.getenv("POLL_CONCURRENCY", "8"))  # одновременных пользователей в опросе
+POLL_JITTER = float(os.getenv("POLL_JITTER", "2"))        # seconds, разброс старта запросов
+POLL_BACKOFF_MAX = int(os.getenv("POLL_BACKOFF_MAX", "300"))  # seconds, потолок интервала без новых матчей
 CACHE_TTL = int(os.getenv("CACHE_TTL", "90"))             # seconds
+OD_BREAKER_ERRORS = int(os.getenv("OD_BREAKER_ERRORS", "5"))      # 429/5xx подряд до паузы
+OD_BREAKER_COOLDOWN = int(os.getenv("OD_BREAKER_COOLDOWN", "60"))  # seconds за каждую ошибку серии
+CONSTANTS_TTL = int(os.getenv("CONSTANTS_TTL", "86400"))  # seconds, /heroes и /constants/*
 MSK_OFFSET = int(os.getenv("MSK_OFFSET", "3"))            # Moscow offset
 ASSUMED_MMR_DELTA = int(os.getenv("ASSUMED_MMR_DELTA", "30"))
+BACKFILL_LIMIT = int(os.getenv("BACKFILL_LIMIT", "100"))  # матчей истории при привязке (0 — не грузить)
+DETAIL_FOR_UNRANKED = os.getenv("DETAIL_FOR_UNRANKED", "1") == "1"  # 0 — не тянуть /matches/{id} для не-ранкед (без роли/NW)
 
 STREAK_NOTIFY_WIN = int(os.getenv("STREAK_NOTIFY_WIN", "5"))
 STREAK_NOTIFY_LOSE = int(os.getenv("STREAK_NOTIFY_LOSE", "5"))
 DAILY_REPORT_HOUR = int(os.getenv("DAILY_REPORT_HOUR", "23"))
 DAILY_REPORT_MINUTE = int(os.getenv("DAILY_REPORT_MINUTE", "59"))
+SEND_CONCURRENCY = int(os.getenv("SEND_CONCURRENCY", "25"))  # одновременных отправок
+SEND_RATE = int(os.getenv("SEND_RATE", "25"))                # сообщений в секунду (лимит Telegram ~30/с на бота)
 
 # Logging
 logging.basicConfig(level=logging.INFO)
@@ -53,244 +75,493 @@ bot = Bot(token=BOT_TOKEN, parse_mode="HTML")
 dp = Dispatcher()
 
 # ---------------- SQLITE ----------------
+# одно соединение на процесс (WAL, autocommit), открывается в init_db()
+_CON: Optional[sqlite3.Connection] = None
+DB_PRAGMAS = ("journal_mode=WAL", "synchronous=NORMAL", "busy_timeout=30000",
+              "temp_store=MEMORY", "cache_size=-20000", "mmap_size=268435456")
+# режим журнала задаёт writer, остальное — настройки соединения, нужны и читателям
+DB_RO_PRAGMAS = tuple(p for p in DB_PRAGMAS if not p.startswith("journal_mode"))
+DB_OPTIMIZE_EVERY = 15 * 60  # seconds
+
+def _add_column(con:sqlite3.Connection, table:str, col:str, decl:str):
+    if col not in {r["name"] for r in con.execute(f"PRAGMA table_info({table})")}:
+        con.execute(f"ALTER TABLE {table} ADD COLUMN {col} {decl}")
+
 def init_db():
-    with closing(sqlite3.connect(DB_PATH)) as con:
-        con.execute("PRAGMA journal_mode=WAL;")
-        con.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            telegram_id INTEGER PRIMARY KEY,
-            steam32 TEXT,
-            exact_mmr INTEGER,
-            current_mmr INTEGER,
-            max_mmr INTEGER,
-            last_any_match INTEGER,
-            last_ranked_match INTEGER,
-            last_rank_tier INTEGER,
-            created_ts INTEGER DEFAULT (strftime('%s','now'))
-        )""")
-        con.execute("""
-        CREATE TABLE IF NOT EXISTS matches (
-            steam32 TEXT,
-            match_id INTEGER,
-            start_time INTEGER,
-            duration INTEGER,
-            hero_id INTEGER,
-            kills INTEGER, deaths INTEGER, assists INTEGER,
-            lobby_type INTEGER, game_mode INTEGER,
-            radiant_win INTEGER, player_slot INTEGER,
-            net_worth INTEGER, gpm INTEGER,
-            delta_mmr INTEGER, mmr_after INTEGER,
-            PRIMARY KEY (steam32, match_id)
-        )""")
-        con.commit()
+    global _CON
+    if _CON is not None:
+        return
+    con = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None, cached_statements=256)
+    con.row_factory = sqlite3.Row
+    for pragma in DB_PRAGMAS:
+        con.execute(f"PRAGMA {pragma};")
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        telegram_id INTEGER PRIMARY KEY,
+        steam32 TEXT,
+        exact_mmr INTEGER,
+        current_mmr INTEGER,
+        max_mmr INTEGER,
+        last_any_match INTEGER,
+        last_ranked_match INTEGER,
+        last_rank_tier INTEGER,
+        created_ts INTEGER DEFAULT (strftime('%s','now')),
+        streak INTEGER
+    )""")
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS matches (
+        steam32 TEXT,
+        match_id INTEGER,
+        start_time INTEGER,
+        duration INTEGER,
+        hero_id INTEGER,
+        kills INTEGER, deaths INTEGER, assists INTEGER,
+        lobby_type INTEGER, game_mode INTEGER,
+        radiant_win INTEGER, player_slot INTEGER,
+        net_worth INTEGER, gpm INTEGER,
+        delta_mmr INTEGER, mmr_after INTEGER,
+        role TEXT,
+        won INTEGER,
+        PRIMARY KEY (steam32, match_id)
+    )""")
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS heroes (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        fetched_at INTEGER NOT NULL
+    )""")
+    _add_column(con, "users", "streak", "INTEGER")  # >0 — винстрик, <0 — лузстрик, NULL — пересчитать
+    _add_column(con, "matches", "role", "TEXT")
+    _add_column(con, "matches", "won", "INTEGER")
+    # победа считается один раз при записи; старые строки добиваем здесь
+    con.execute("UPDATE matches SET won=((player_slot<128)=(radiant_win=1)) WHERE won IS NULL")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_matches_steam_start ON matches(steam32, start_time DESC)")
+    con.execute("DROP INDEX IF EXISTS idx_matches_steam_lobby_start")  # запросов по (steam32, lobby_type, start_time) больше нет
+    con.execute("CREATE INDEX IF NOT EXISTS idx_matches_steam_hero ON matches(steam32, hero_id)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_matches_steam_role ON matches(steam32, role)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_matches_start ON matches(start_time)")  # окно дня по всем аккаунтам (db_daily_stats)
+    con.execute("CREATE INDEX IF NOT EXISTS idx_users_steam ON users(steam32) WHERE steam32 IS NOT NULL")  # опрос берёт только привязанных
+    _CON = con
+
+# агрегирующие SELECT'ы идут через read-only соединение своего потока и
+# вызываются из хендлеров через db_read(), чтобы не блокировать event loop
+_ro_local = threading.local()
+
+def _ro_con() -> sqlite3.Connection:
+    con = getattr(_ro_local, "con", None)
+    if con is None:
+        con = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True, check_same_thread=False, cached_statements=256)
+        con.row_factory = sqlite3.Row
+        for pragma in DB_RO_PRAGMAS:
+            con.execute(f"PRAGMA {pragma};")
+        _ro_local.con = con
+    return con
+
+async def db_read(fn, *args):
+    return await asyncio.to_thread(fn, *args)
+
+def db_optimize():
+    _CON.execute("PRAGMA optimize;")
+
+@contextmanager
+def db_tx():
+    # одна транзакция (один fsync) на группу записей; вложенные вызовы — no-op
+    if _CON.in_transaction:
+        yield; return
+    _CON.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        _CON.execute("ROLLBACK")
+        _user_cache.clear()  # write-through кэш мог уйти вперёд откатившейся транзакции
+        raise
+    _CON.execute("COMMIT")
+
+# строки users по telegram_id (write-through): writer'ы ниже правят закэшированную
+# строку вслед за UPDATE, опрос заполняет кэш целиком из db_get_all_users_with_steam
+_user_cache: Dict[int, Dict[str,Any]] = {}
+
+def _user_cache_set(tg:int, **cols):
+    u = _user_cache.get(tg)
+    if u is not None: u.update(cols)
 
 def db_get_user(tg:int) -> Optional[Dict[str,Any]]:
-    with closing(sqlite3.connect(DB_PATH)) as con:
-        con.row_factory = sqlite3.Row
-        r = con.execute("SELECT * FROM users WHERE telegram_id=?", (tg,)).fetchone()
-        return dict(r) if r else None
+    u = _user_cache.get(tg)
+    if u is None:
+        r = _CON.execute("SELECT * FROM users WHERE telegram_id=?", (tg,)).fetchone()
+        if not r: return None
+        u = _user_cache[tg] = dict(r)
+    return dict(u)
 
 def db_set_user_steam(tg:int, steam32:int):
-    with closing(sqlite3.connect(DB_PATH)) as con:
-        con.execute("""
-        INSERT INTO users (telegram_id, steam32) VALUES (?,?)
-        ON CONFLICT(telegram_id) DO UPDATE SET steam32=excluded.steam32
-        """, (tg, str(steam32)))
-        con.commit()
+    _CON.execute("""
+    INSERT INTO users (telegram_id, steam32) VALUES (?,?)
+    ON CONFLICT(telegram_id) DO UPDATE SET steam32=excluded.steam32, streak=NULL
+    """, (tg, str(steam32)))
+    _user_cache.pop(tg, None)
 
 def db_update_exact_mmr(tg:int, mmr:Optional[int]):
-    with closing(sqlite3.connect(DB_PATH)) as con:
-        con.execute("UPDATE users SET exact_mmr=? WHERE telegram_id=?", (mmr, tg))
-        con.commit()
+    _CON.execute("UPDATE users SET exact_mmr=? WHERE telegram_id=?", (mmr, tg))
+    _user_cache_set(tg, exact_mmr=mmr)
 
 def db_update_auto_mmr(tg:int, mmr:Optional[int]):
-    with closing(sqlite3.connect(DB_PATH)) as con:
-        if mmr is None:
-            con.execute("UPDATE users SET current_mmr=NULL WHERE telegram_id=?", (tg,))
-        else:
-            con.execute("""
-            UPDATE users SET current_mmr=?, max_mmr=MAX(COALESCE(max_mmr,0),?) WHERE telegram_id=?
-            """, (mmr, mmr, tg))
-        con.commit()
+    if mmr is None:
+        _CON.execute("UPDATE users SET current_mmr=NULL WHERE telegram_id=?", (tg,))
+    else:
+        _CON.execute("""
+        UPDATE users SET current_mmr=?, max_mmr=MAX(COALESCE(max_mmr,0),?) WHERE telegram_id=?
+        """, (mmr, mmr, tg))
+    u = _user_cache.get(tg)
+    if u is not None:
+        u["current_mmr"] = mmr
+        if mmr is not None: u["max_mmr"] = max(u.get("max_mmr") or 0, mmr)
+
+def db_update_max_mmr(tg:int, mmr:int):
+    _CON.execute("UPDATE users SET max_mmr=MAX(COALESCE(max_mmr,0),?) WHERE telegram_id=?", (mmr, tg))
+    u = _user_cache.get(tg)
+    if u is not None: u["max_mmr"] = max(u.get("max_mmr") or 0, mmr)
 
 def db_set_last_ids(tg:int, any_id:Optional[int]=None, ranked_id:Optional[int]=None):
-    with closing(sqlite3.connect(DB_PATH)) as con:
-        if any_id is not None:
-            con.execute("UPDATE users SET last_any_match=? WHERE telegram_id=?", (any_id, tg))
-        if ranked_id is not None:
-            con.execute("UPDATE users SET last_ranked_match=? WHERE telegram_id=?", (ranked_id, tg))
-        con.commit()
+    if any_id is not None:
+        _CON.execute("UPDATE users SET last_any_match=? WHERE telegram_id=?", (any_id, tg))
+        _user_cache_set(tg, last_any_match=any_id)
+    if ranked_id is not None:
+        _CON.execute("UPDATE users SET last_ranked_match=? WHERE telegram_id=?", (ranked_id, tg))
+        _user_cache_set(tg, last_ranked_match=ranked_id)
+
+def db_set_streak(tg:int, streak:Optional[int]):
+    _CON.execute("UPDATE users SET streak=? WHERE telegram_id=?", (streak, tg))
+    _user_cache_set(tg, streak=streak)
 
 def db_set_last_rank_tier(tg:int, tier:Optional[int]):
-    with closing(sqlite3.connect(DB_PATH)) as con:
-        con.execute("UPDATE users SET last_rank_tier=? WHERE telegram_id=?", (tier, tg))
-        con.commit()
-
-def db_upsert_match(steam32:str, m:dict, nw:Optional[int], gpm:Optional[int], delta:Optional[int], mmr_after:Optional[int]):
-    with closing(sqlite3.connect(DB_PATH)) as con:
-        con.execute("""
-        INSERT INTO matches (steam32, match_id, start_time, duration, hero_id, kills, deaths, assists,
-            lobby_type, game_mode, radiant_win, player_slot, net_worth, gpm, delta_mmr, mmr_after)
-        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-        ON CONFLICT(steam32, match_id) DO UPDATE SET
-            start_time=excluded.start_time, duration=excluded.duration, hero_id=excluded.hero_id,
-            kills=excluded.kills, deaths=excluded.deaths, assists=excluded.assists,
-            lobby_type=excluded.lobby_type, game_mode=excluded.game_mode,
-            radiant_win=excluded.radiant_win, player_slot=excluded.player_slot,
-            net_worth=excluded.net_worth, gpm=excluded.gpm, delta_mmr=excluded.delta_mmr, mmr_after=excluded.mmr_after
-        """, (
-            steam32,
-            m.get("match_id"), m.get("start_time"), m.get("duration"), m.get("hero_id"),
-            m.get("kills",0), m.get("deaths",0), m.get("assists",0),
-            m.get("lobby_type"), m.get("game_mode"), int(bool(m.get("radiant_win"))),
-            m.get("player_slot"), nw, gpm, delta, mmr_after
-        ))
-        con.commit()
+    _CON.execute("UPDATE users SET last_rank_tier=? WHERE telegram_id=?", (tier, tg))
+    _user_cache_set(tg, last_rank_tier=tier)
+
+_INSERT_MATCH_SQL = """
+INSERT INTO matches (steam32, match_id, start_time, duration, hero_id, kills, deaths, assists,
+    lobby_type, game_mode, radiant_win, player_slot, net_worth, gpm, delta_mmr, mmr_after, role, won)
+VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+"""
+# догрузка истории не должна затирать уже посчитанные delta/NW/role
+_BACKFILL_MATCH_SQL = _INSERT_MATCH_SQL + "ON CONFLICT(steam32, match_id) DO NOTHING"
+_UPSERT_MATCH_SQL = _INSERT_MATCH_SQL + """ON CONFLICT(steam32, match_id) DO UPDATE SET
+    start_time=excluded.start_time, duration=excluded.duration, hero_id=excluded.hero_id,
+    kills=excluded.kills, deaths=excluded.deaths, assists=excluded.assists,
+    lobby_type=excluded.lobby_type, game_mode=excluded.game_mode,
+    radiant_win=excluded.radiant_win, player_slot=excluded.player_slot,
+    net_worth=excluded.net_worth, gpm=excluded.gpm, delta_mmr=excluded.delta_mmr, mmr_after=excluded.mmr_after,
+    role=COALESCE(excluded.role, matches.role), won=excluded.won
+"""
+
+def _match_row(steam32:str, m:dict, nw:Optional[int], gpm:Optional[int], delta:Optional[int], mmr_after:Optional[int], role:Optional[str]=None) -> tuple:
+    return (
+        steam32,
+        m.get("match_id"), m.get("start_time"), m.get("duration"), m.get("hero_id"),
+        m.get("kills",0), m.get("deaths",0), m.get("assists",0),
+        m.get("lobby_type"), m.get("game_mode"), int(bool(m.get("radiant_win"))),
+        m.get("player_slot"), nw, gpm, delta, mmr_after, role,
+        int(is_player_win(m.get("player_slot") or 0, bool(m.get("radiant_win"))))
+    )
+
+def db_backfill_matches(steam32:str, matches:List[dict]):
+    with db_tx():
+        _CON.executemany(_BACKFILL_MATCH_SQL, [_match_row(steam32, m, None, None, None, None) for m in matches])
 
 def db_last_matches(steam32:str, limit:int=10) -> List[Dict[str,Any]]:
-    with closing(sqlite3.connect(DB_PATH)) as con:
-        con.row_factory = sqlite3.Row
-        rs = con.execute("SELECT * FROM matches WHERE steam32=? ORDER BY start_time DESC LIMIT ?", (steam32, limit)).fetchall()
-        return [dict(r) for r in rs]
+    rs = _ro_con().execute("SELECT * FROM matches WHERE steam32=? ORDER BY start_time DESC LIMIT ?", (steam32, limit)).fetchall()
+    return [dict(r) for r in rs]
 
-def db_get_all_users_with_steam() -> List[Dict[str,Any]]:
-    with closing(sqlite3.connect(DB_PATH)) as con:
-        con.row_factory = sqlite3.Row
-        rs = con.execute("SELECT * FROM users WHERE steam32 IS NOT NULL").fetchall()
-        return [dict(r) for r in rs]
+# IN-список добивается NULL'ами до 10: один и тот же текст SQL -> одно подготовленное выражение в кэше
+_DELTAS_IN = 10
 
-def db_sum_delta_mmr_today(steam32:str, start_ts:int, end_ts:int) -> int:
-    with closing(sqlite3.connect(DB_PATH)) as con:
-        con.row_factory = sqlite3.Row
-        r = con.execute("""
-            SELECT SUM(COALESCE(delta_mmr,0)) s FROM matches
-            WHERE steam32=? AND lobby_type=7 AND start_time BETWEEN ? AND ?
-        """, (steam32, start_ts, end_ts)).fetchone()
-        return int(r["s"]) if r and r["s"] is not None else 0
+def db_match_deltas(steam32:str, match_ids:List[int]) -> Dict[int,Tuple[Optional[int],Optional[int]]]:
+    if not match_ids: return {}
+    n = max(len(match_ids), _DELTAS_IN)
+    rs = _ro_con().execute(f"SELECT match_id, delta_mmr, mmr_after FROM matches WHERE steam32=? AND match_id IN ({','.join('?'*n)})",
+                      (steam32, *match_ids, *[None]*(n - len(match_ids)))).fetchall()
+    return {r["match_id"]: (r["delta_mmr"], r["mmr_after"]) for r in rs}
+
+def db_get_all_users_with_steam() -> List[Dict[str,Any]]:
+    rs = _CON.execute("SELECT * FROM users WHERE steam32 IS NOT NULL").fetchall()
+    for r in rs:
+        _user_cache[r["telegram_id"]] = dict(r)
+    # steam32 хранится текстом; int для OpenDota разбираем один раз здесь, а не в каждом воркере
+    return [{**r, "steam32_int": int(r["steam32"])} for r in rs]
+
+# игры/победы/Δ MMR (ranked) за окно сразу по всем аккаунтам — одним GROUP BY
+_DAILY_STATS_SQL = """
+SELECT steam32, COUNT(*) g,
+       SUM(won) w,
+       SUM(CASE WHEN lobby_type=7 THEN COALESCE(delta_mmr,0) ELSE 0 END) dm
+FROM matches WHERE start_time BETWEEN ? AND ? GROUP BY steam32
+"""
+
+def db_daily_stats(start_ts:int, end_ts:int) -> Dict[str,Dict[str,int]]:
+    rs = _ro_con().execute(_DAILY_STATS_SQL, (start_ts, end_ts)).fetchall()
+    return {r["steam32"]: {"g": r["g"], "w": r["w"], "dm": r["dm"]} for r in rs}
+
+_ROLE_WR_SQL = """
+SELECT role, COUNT(*) g,
+       SUM(won) w
+FROM matches WHERE steam32=? AND role IN ('core','support') GROUP BY role
+"""
 
 def db_role_wr(steam32:str) -> Dict[str,Dict[str,int]]:
-    with closing(sqlite3.connect(DB_PATH)) as con:
-        con.row_factory = sqlite3.Row
-        rs = con.execute("SELECT role, radiant_win, player_slot FROM matches WHERE steam32=? AND role IS NOT NULL", (steam32,)).fetchall()
+    rs = _ro_con().execute(_ROLE_WR_SQL, (steam32,)).fetchall()
     stat = {"core":{"g":0,"w":0}, "support":{"g":0,"w":0}}
-    for r in rs:
-        role = r["role"]
-        if role not in stat: continue
-        win = ((r["player_slot"]<128) and (r["radiant_win"]==1)) or ((r["player_slot"]>=128) and (r["radiant_win"]==0))
-        stat[role]["g"] += 1
-        if win: stat[role]["w"] += 1
+    stat.update({r["role"]: {"g": r["g"], "w": r["w"]} for r in rs})
     return stat
 
-def db_hero_aggregates(steam32:str) -> List[Dict[str,Any]]:
-    with closing(sqlite3.connect(DB_PATH)) as con:
-        con.row_factory = sqlite3.Row
-        rs = con.execute("""
-        SELECT hero_id, COUNT(*) games,
-               SUM(CASE WHEN ((player_slot<128 AND radiant_win=1) OR (player_slot>=128 AND radiant_win=0)) THEN 1 ELSE 0 END) wins,
-               AVG(COALESCE(net_worth,0)) avg_nw
-        FROM matches WHERE steam32=? GROUP BY hero_id ORDER BY games DESC
-        """, (steam32,)).fetchall()
-        return [dict(r) for r in rs]
+# ORDER BY подставляется в SQL только из этого словаря
+HERO_SORT_SQL = {"games": "games DESC", "wr": "wr DESC, games DESC", "kda": "kda DESC, games DESC", "nw": "avg_nw DESC, games DESC"}
+
+# готовый текст запроса на каждый вариант сортировки
+_HERO_AGG_SQL = {k: f"""
+SELECT hero_id, COUNT(*) games,
+       SUM(won) wins,
+       AVG(COALESCE(net_worth,0)) avg_nw,
+       SUM(won)*100.0/COUNT(*) wr,
+       (SUM(COALESCE(kills,0))+SUM(COALESCE(assists,0)))*1.0/MAX(SUM(COALESCE(deaths,0)),1) kda
+FROM matches WHERE steam32=? GROUP BY hero_id HAVING COUNT(*) >= ?
+ORDER BY {order} LIMIT ?
+""" for k, order in HERO_SORT_SQL.items()}
+
+def db_hero_aggregates(steam32:str, sort_by:str="games", min_games:int=0, limit:int=-1) -> List[Dict[str,Any]]:
+    rs = _ro_con().execute(_HERO_AGG_SQL[sort_by], (steam32, min_games, limit)).fetchall()
+    return [dict(r) for r in rs]
+
+def db_has_matches(steam32:str) -> bool:
+    return _ro_con().execute("SELECT EXISTS(SELECT 1 FROM matches WHERE steam32=?)", (steam32,)).fetchone()[0] == 1
+
+# справочник героев переживает рестарт: после запуска /heroes не дёргаем, пока он свежий
+def db_load_heroes() -> Tuple[Dict[int,str], int]:
+    rs = _CON.execute("SELECT id, name, fetched_at FROM heroes").fetchall()
+    return {r["id"]: r["name"] for r in rs}, min((r["fetched_at"] for r in rs), default=0)
+
+def db_save_heroes(heroes:Dict[int,str], fetched_at:int):
+    with db_tx():
+        _CON.execute("DELETE FROM heroes")
+        _CON.executemany("INSERT INTO heroes(id, name, fetched_at) VALUES(?,?,?)",
+                         [(hid, name, fetched_at) for hid, name in heroes.items()])
 
 # ---------------- OpenDota cache + helpers ----------------
-_open_dota_cache: Dict[str, Tuple[float, Any]] = {}  # key -> (ts, data)
+OD_CACHE_MAX = 1024
+_open_dota_cache: "OrderedDict[tuple, Tuple[float, Any]]" = OrderedDict()  # key -> (monotonic ts, data), LRU
+_inflight: Dict[tuple, asyncio.Future] = {}  # key -> общий запрос для одновременных промахов
+_SESSION: Optional[aiohttp.ClientSession] = None      # keep-alive пул к api.opendota.com
+
+def od_session() -> aiohttp.ClientSession:
+    global _SESSION
+    if _SESSION is None or _SESSION.closed:
+        _SESSION = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=20, keepalive_timeout=60, ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(total=25))
+    return _SESSION
+
+# circuit breaker: серия 429/5xx/таймаутов -> все запросы к OpenDota на паузе
+_od_err_streak = 0
+_od_open_until = 0.0  # monotonic
+
+def od_circuit_open() -> bool:
+    return time.monotonic() < _od_open_until
+
+def _od_failed(retry_after:Optional[str]=None):
+    global _od_err_streak, _od_open_until
+    _od_err_streak += 1
+    pause = OD_BREAKER_COOLDOWN * _od_err_streak if _od_err_streak >= OD_BREAKER_ERRORS else 0
+    if retry_after and retry_after.isdigit():
+        pause = max(pause, int(retry_after))
+    if pause:
+        _od_open_until = max(_od_open_until, time.monotonic() + pause)
+        logger.warning("OpenDota circuit open for %ss (errors in a row: %s)", pause, _od_err_streak)
+
+async def _od_fetch(path:str, params:dict=None):
+    global _od_err_streak
+    if od_circuit_open():
+        return None
+    url = OPEN_DOTA + path
+    # значение-кортеж -> повторяющийся ключ (?project=a&project=b)
+    query = [(k, x) for k, v in params.items() for x in (v if isinstance(v, tuple) else (v,))] if params else None
+    try:
+        async with od_session().get(url, params=query) as r:
+            if r.status == 429 or r.status >= 500:
+                _od_failed(r.headers.get("Retry-After"))
+            else:
+                _od_err_streak = 0
+            if r.status == 404:
+                return None
+            r.raise_for_status()
+            return json_loads(await r.read())
+    except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+        _od_failed()
+        logger.warning("OpenDota request failed: %s %s", url, e)
+        return None
+    except Exception as e:
+        logger.warning("OpenDota request failed: %s %s", url, e)
+        return None
 
 async def od_get(path:str, params:dict=None, use_cache:bool=True):
-    key = path + (f"?{json.dumps(params, sort_keys=True)}" if params else "")
-    now = time.time()
+    key = (path, tuple(sorted(params.items())) if params else ())
+    now = time.monotonic()
     if use_cache and key in _open_dota_cache:
         ts, data = _open_dota_cache[key]
         if now - ts < CACHE_TTL:
+            _open_dota_cache.move_to_end(key)
             return data
-    url = OPEN_DOTA + path
+    fut = _inflight.get(key)
+    if fut is not None:
+        return await asyncio.shield(fut)
+    fut = asyncio.get_running_loop().create_future()
+    _inflight[key] = fut
     try:
-        async with aiohttp.ClientSession() as s:
-            async with s.get(url, params=params, timeout=25) as r:
-                if r.status == 404:
-                    data = None
-                else:
-                    r.raise_for_status()
-                    data = await r.json()
-    except Exception as e:
-        logger.warning("OpenDota request failed: %s %s", url, e)
-        data = None
-    _open_dota_cache[key] = (now, data)
+        data = await _od_fetch(path, params)
+        if use_cache and not od_circuit_open():  # пустой ответ из-за паузы не кэшируем
+            _open_dota_cache[key] = (now, data)
+            _open_dota_cache.move_to_end(key)
+            if len(_open_dota_cache) > OD_CACHE_MAX:
+                _open_dota_cache.popitem(last=False)
+        fut.set_result(data)
+    finally:
+        _inflight.pop(key, None)
+        if not fut.done():
+            fut.cancel()
     return data
 
+# поля /players/{id}/matches, которые реально читаем (project= режет ответ до них)
+MATCH_FIELDS = ("match_id", "start_time", "duration", "hero_id", "kills", "deaths", "assists",
+                "lobby_type", "game_mode", "radiant_win", "player_slot")
+TREND_FIELDS = ("match_id", "radiant_win", "player_slot")
+
 async def od_player(steam32:int): return await od_get(f"/players/{steam32}")
 async def od_matches(steam32:int, limit:int=10, params:dict=None): return await od_get(f"/players/{steam32}/matches", params={**({"limit":limit} if limit else {}), **(params or {})})
 async def od_recent(steam32:int): return await od_get(f"/players/{steam32}/recentMatches")
-async def od_heroes_map(): return await od_get("/heroes")
+async def od_heroes_map(): return await od_get("/heroes", use_cache=False)
+async def od_game_modes(): return await od_get("/constants/game_mode", use_cache=False)
 async def od_player_heroes(steam32:int): return await od_get(f"/players/{steam32}/heroes")
 async def od_wl(steam32:int): return await od_get(f"/players/{steam32}/wl")
 async def od_match_detail(match_id:int): return await od_get(f"/matches/{match_id}", use_cache=False)
 
+# сыгранный матч не меняется: детали держим в отдельном LRU по match_id, без TTL
+MATCH_DETAIL_CACHE_MAX = 256
+_match_detail_cache: "OrderedDict[int, dict]" = OrderedDict()
+
+async def get_match_detail(match_id:int) -> Optional[dict]:
+    if match_id in _match_detail_cache:
+        _match_detail_cache.move_to_end(match_id)
+        return _match_detail_cache[match_id]
+    d = await od_match_detail(match_id)
+    if d:
+        _match_detail_cache[match_id] = d
+        if len(_match_detail_cache) > MATCH_DETAIL_CACHE_MAX:
+            _match_detail_cache.popitem(last=False)
+    return d
+
+# справочники героев/режимов меняются раз в патч: грузим при старте и раз в CONSTANTS_TTL
+HEROES_BY_ID: Dict[int,str] = {}
+GAME_MODES_BY_ID: Dict[int,str] = {}
+_heroes_fetched_at = 0  # unix ts, когда HEROES_BY_ID пришёл из OpenDota
+
+async def load_constants():
+    global HEROES_BY_ID, GAME_MODES_BY_ID, _heroes_fetched_at
+    if not HEROES_BY_ID:
+        HEROES_BY_ID, _heroes_fetched_at = db_load_heroes()
+    heroes_stale = time.time() - _heroes_fetched_at >= CONSTANTS_TTL
+    modes, *heroes = await asyncio.gather(od_game_modes(), *([od_heroes_map()] if heroes_stale else []))
+    if heroes and heroes[0]:
+        HEROES_BY_ID = heroes_id_to_name(heroes[0]); _heroes_fetched_at = int(time.time())
+        db_save_heroes(HEROES_BY_ID, _heroes_fetched_at)
+    if modes: GAME_MODES_BY_ID = game_modes_id_to_name(modes)
+    logger.info("Constants loaded: %d heroes, %d game modes", len(HEROES_BY_ID), len(GAME_MODES_BY_ID))
+
+async def constants_worker():
+    while True:
+        # до устаревания справочника (копия из БД могла быть уже не первой свежести);
+        # герои или режимы пусты, либо обновить не удалось — пробуем раз в минуту
+        await asyncio.sleep(60 if not GAME_MODES_BY_ID or not HEROES_BY_ID
+                            else max(60, _heroes_fetched_at + CONSTANTS_TTL - time.time()))
+        try:
+            await load_constants()
+        except Exception as e:
+            logger.exception("constants_worker failure: %s", e)
+
 # ---------------- Utilities ----------------
 STEAM_PROFILE_RE = re.compile(r"(?:https?://)?steamcommunity\.com/(?:id|profiles)/([^/\s]+)", re.I)
 STEAM64_OFFSET = 76561197960265728
+LOBBY_NAMES = {0:"Unranked",1:"Practice",2:"Tournament",3:"Tutorial",4:"Co-op Bots",5:"Ranked Team",6:"Ranked Solo",7:"Ranked",8:"1v1 Mid",9:"Battle Cup"}
+GAME_MODE_FALLBACK = {1:"All Pick",2:"Captains Mode",3:"Random Draft",4:"Single Draft",5:"All Random",12:"Least Played",13:"Limited Heroes",14:"Compendium",15:"Custom",16:"Captains Draft",17:"Balanced Draft",18:"Ability Draft",19:"Event",20:"ARDM",21:"1v1 Mid",22:"All Draft",23:"Turbo"}
+RANK_NAMES = ("Herald","Guardian","Crusader","Archon","Legend","Ancient","Divine","Immortal")  # rank_tier // 10 - 1
+RANK_BASE_MMR = {1:0,2:600,3:1200,4:1800,5:2600,6:3400,7:4400,8:5400}
+MMR_RE = re.compile(r"\s*mmr\s*[:=]?\s*(\d{2,5})\s*", re.I)  # "mmr 4321", "mmr:4321", "MMR4321"
 
 def parse_steam_any(text:str) -> Optional[int]:
-    text = (text or "").strip()
-    m = STEAM_PROFILE_RE.search(text)
+    t = (text or "").strip()
+    if not t: return None
+    m = STEAM_PROFILE_RE.search(t)
     if m:
+        # /id/<vanity> не резолвим — только /profiles/<steam64>
         part = m.group(1)
         if part.isdigit() and len(part) >= 16:
             return int(part) - STEAM64_OFFSET
         return None
-    if text.isdigit():
-        if len(text) >= 16:
-            return int(text) - STEAM64_OFFSET
-        return int(text)
+    if t.isdigit():
+        return int(t) - STEAM64_OFFSET if len(t) >= 16 else int(t)
     return None
 
+MSK_TZ = timezone(timedelta(hours=MSK_OFFSET))
+MSK_OFFSET_S = MSK_OFFSET * 3600
+TS_FMT = "%d.%m.%Y %H:%M МСК"
+
+def msk_today_midnight_ts() -> int:
+    # unix-время начала текущих суток по МСК, без datetime
+    return (int(time.time()) + MSK_OFFSET_S) // 86400 * 86400 - MSK_OFFSET_S
+
 def fmt_duration(sec:int) -> str:
     sec = int(max(0, sec or 0))
-    mm, ss = divmod(sec, 60)
-    hh, mm = divmod(mm, 60)
-    return f"{hh}:{mm:02d}:{ss:02d}" if hh else f"{mm}:{ss:02d}"
+    if sec >= 3600:
+        return f"{sec//3600}:{sec//60%60:02d}:{sec%60:02d}"
+    return f"{sec//60}:{sec%60:02d}"
 
+@lru_cache(maxsize=4096)  # одни и те же матчи перерисовываются в списках и карточках
 def ts_msk(ts:int) -> str:
-    dt = datetime.fromtimestamp(ts, tz=timezone.utc) + timedelta(hours=MSK_OFFSET)
-    return dt.strftime("%d.%m.%Y %H:%M МСК")
+    return datetime.fromtimestamp(ts, MSK_TZ).strftime(TS_FMT)
 
 def is_player_win(player_slot:int, radiant_win:bool) -> bool:
-    rad = player_slot < 128
-    return (rad and radiant_win) or ((not rad) and (not radiant_win))
+    return (player_slot < 128) == bool(radiant_win)
 
 def safe_kda(k,d,a) -> float:
     return round(((k or 0) + (a or 0)) / max(1, (d or 0)), 2)
 
-def hero_name_from_map(hero_id:int, heroes_map:List[dict]) -> str:
-    if not heroes_map: return f"Hero {hero_id}"
-    for h in heroes_map:
-        if h.get("id")==hero_id:
-            return h.get("localized_name") or f"Hero {hero_id}"
-    return f"Hero {hero_id}"
+def heroes_id_to_name(heroes_map:Optional[List[dict]]) -> Dict[int,str]:
+    return {h["id"]: h.get("localized_name") or f"Hero {h['id']}" for h in heroes_map or [] if "id" in h}
+
+def hero_name(hero_id:int) -> str:
+    return HEROES_BY_ID.get(hero_id) or f"Hero {hero_id}"
 
 def lobby_name(lobby:int) -> str:
-    table = {0:"Unranked",1:"Practice",2:"Tournament",3:"Tutorial",4:"Co-op Bots",5:"Ranked Team",6:"Ranked Solo",7:"Ranked",8:"1v1 Mid",9:"Battle Cup"}
-    return table.get(lobby, "Custom/Unknown")
+    return LOBBY_NAMES.get(lobby, "Custom/Unknown")
 
-def game_mode_name(mode:int, gm_map:dict) -> str:
-    fallback = {1:"All Pick",2:"Captains Mode",3:"Random Draft",4:"Single Draft",5:"All Random",12:"Least Played",13:"Limited Heroes",14:"Compendium",15:"Custom",16:"Captains Draft",17:"Balanced Draft",18:"Ability Draft",19:"Event",20:"ARDM",21:"1v1 Mid",22:"All Draft",23:"Turbo"}
-    if gm_map:
-        for k,v in gm_map.items():
-            try:
-                if int(v.get("id",-1)) == mode:
-                    return v.get("name","").replace("game_mode_","").replace("_"," ").title()
-            except Exception:
-                pass
-    return fallback.get(mode, f"Mode {mode}")
+def game_modes_id_to_name(gm_map:Optional[dict]) -> Dict[int,str]:
+    out = {}
+    for v in (gm_map or {}).values():
+        try:
+            out[int(v.get("id",-1))] = v.get("name","").replace("game_mode_","").replace("_"," ").title()
+        except Exception:
+            pass
+    return out
+
+def game_mode_name(mode:int) -> str:
+    if mode in GAME_MODES_BY_ID:
+        return GAME_MODES_BY_ID[mode]
+    return GAME_MODE_FALLBACK.get(mode, f"Mode {mode}")
 
 def approx_mmr_from_rank_tier(rank_tier:Optional[int]) -> Optional[int]:
     if not isinstance(rank_tier, int): return None
-    base = {1:0,2:600,3:1200,4:1800,5:2600,6:3400,7:4400,8:5400}
     major = rank_tier // 10
     minor = rank_tier % 10
-    if major not in base: return None
+    if major not in RANK_BASE_MMR: return None
     if major == 8:
-        return base[major]
-    return base[major] + (minor-1)*200
+        return RANK_BASE_MMR[major]
+    return RANK_BASE_MMR[major] + (minor-1)*200
 
 def mmr_progress_text(rank_tier:Optional[int], exact_mmr:Optional[int]) -> Optional[str]:
     if exact_mmr is None:
@@ -304,16 +575,97 @@ def mmr_progress_text(rank_tier:Optional[int], exact_mmr:Optional[int]) -> Optio
     need = max(0, next_border - exact_mmr)
     return f"до следующей звезды ≈ {need} MMR"
 
-def guess_role_from_purchase_and_gpm(purchase_keys:List[str], gpm:int) -> str:
-    core_items = {"bkb","manta","daedalus","skadi","desolator","battle_fury","butterfly","radiance","satanic"}
-    support_items = {"mekansm","glimmer_cape","force_staff","guardian_greaves","lotus_orb","pipe","urn_of_shadows","spirit_vessel"}
-    s = set(purchase_keys or [])
+CORE_ITEMS = frozenset({"bkb","manta","daedalus","skadi","desolator","battle_fury","butterfly","radiance","satanic"})
+SUPPORT_ITEMS = frozenset({"mekansm","glimmer_cape","force_staff","guardian_greaves","lotus_orb","pipe","urn_of_shadows","spirit_vessel"})
+
+def guess_role_from_purchase_and_gpm(purchase_keys:Iterable[str], gpm:int) -> str:
     if gpm and gpm >= 420: return "core"
-    if any(x in s for x in core_items): return "core"
-    if any(x in s for x in support_items): return "support"
+    # покупки читаем лениво: первый кор-предмет решает сразу, саппорт-предмет — только если кор так и не встретился
+    support = False
+    for key in purchase_keys or ():
+        if key in CORE_ITEMS: return "core"
+        support = support or key in SUPPORT_ITEMS
+    if support: return "support"
     if gpm and gpm < 350: return "support"
     return "core"
 
+# ---------------- Charts ----------------
+CHART_CACHE_TTL = 3600  # seconds
+_chart_cache: Dict[str, Tuple[float, tuple, bytes]] = {}  # key -> (ts, данные графика, png)
+
+def chart_cache_get(key:str, sig:tuple) -> Optional[bytes]:
+    hit = _chart_cache.get(key)
+    if hit and hit[1] == sig and time.time() - hit[0] < CHART_CACHE_TTL:
+        return hit[2]
+    return None
+
+def chart_cache_put(key:str, sig:tuple, png:bytes):
+    now = time.time()
+    for k in [k for k,v in _chart_cache.items() if now - v[0] >= CHART_CACHE_TTL]:
+        del _chart_cache[k]
+    _chart_cache[key] = (now, sig, png)
+
+# 7 столбиков или одна линия: рисуем прямо в PIL.Image, без фигур/осей/layout matplotlib
+CHART_W, CHART_H = 700, 300
+CHART_PAD_L, CHART_PAD_T, CHART_PAD_R, CHART_PAD_B = 56, 36, 18, 30
+CHART_COLOR, CHART_GRID, CHART_TEXT = (31,119,180), (225,225,225), (40,40,40)
+_FONT_PATH = os.path.join(matplotlib.get_data_path(), "fonts", "ttf", "DejaVuSans.ttf")
+_FONT = ImageFont.truetype(_FONT_PATH, 12)
+_FONT_TITLE = ImageFont.truetype(_FONT_PATH, 15)
+_chart_lock = threading.Lock()  # рендер идёт в to_thread; шрифты FreeType общие
+
+ACTIVITY_TITLE = "Активность (последние 7 дней)"
+MMR_TITLE = "Тренд условного MMR (последние ранк)"
+
+def _nice_step(span:float) -> float:
+    # шаг сетки 1/2/5·10^k, чтобы вышло ~4 деления
+    raw = max(span / 4, 1)
+    mag = 10 ** math.floor(math.log10(raw))
+    return next(k * mag for k in (1, 2, 5, 10) if k * mag >= raw)
+
+def _chart_canvas(title:str, lo:float, hi:float):
+    # холст с заголовком и сеткой по «круглым» значениям; возвращает (img, draw, y(v) -> пиксель)
+    step = _nice_step(hi - lo)
+    lo = math.floor(lo / step) * step; hi = max(math.ceil(hi / step) * step, lo + step)
+    img = Image.new("RGB", (CHART_W, CHART_H), "white")
+    draw = ImageDraw.Draw(img)
+    draw.text((CHART_W // 2, 8), title, font=_FONT_TITLE, fill=CHART_TEXT, anchor="mt")
+    top, bottom = CHART_PAD_T, CHART_H - CHART_PAD_B
+    y = lambda v: bottom - (v - lo) / (hi - lo) * (bottom - top)
+    for i in range(round((hi - lo) / step) + 1):
+        v = lo + step * i; yy = y(v)
+        draw.line([(CHART_PAD_L, yy), (CHART_W - CHART_PAD_R, yy)], fill=CHART_GRID)
+        draw.text((CHART_PAD_L - 6, yy), f"{v:.0f}", font=_FONT, fill=CHART_TEXT, anchor="rm")
+    return img, draw, y
+
+def _img_png(img:Image.Image) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, "PNG", compress_level=1)
+    return buf.getvalue()
+
+def _render_activity_png(xs:List[str], ys:List[int]) -> bytes:
+    with _chart_lock:
+        img, draw, y = _chart_canvas(ACTIVITY_TITLE, 0, max(ys, default=0))
+        slot = (CHART_W - CHART_PAD_L - CHART_PAD_R) / max(len(xs), 1)
+        for i, (label, v) in enumerate(zip(xs, ys)):
+            cx = CHART_PAD_L + slot * (i + 0.5)
+            if v: draw.rectangle([cx - slot*0.3, y(v), cx + slot*0.3, y(0)], fill=CHART_COLOR)
+            draw.text((cx, CHART_H - CHART_PAD_B + 6), label, font=_FONT, fill=CHART_TEXT, anchor="mt")
+        return _img_png(img)
+
+def _render_mmr_png(xs:List[int], ys:List[int]) -> bytes:
+    with _chart_lock:
+        img, draw, y = _chart_canvas(MMR_TITLE, min(ys, default=0), max(ys, default=0))
+        n = len(xs); step = (CHART_W - CHART_PAD_L - CHART_PAD_R - 20) / max(n - 1, 1)
+        pts = [(CHART_PAD_L + 10 + step * i, y(v)) for i, v in enumerate(ys)]
+        if n > 1: draw.line(pts, fill=CHART_COLOR, width=2)
+        every = math.ceil(n / 12) or 1
+        for i, (px, py) in enumerate(pts):
+            draw.ellipse([px - 3, py - 3, px + 3, py + 3], fill=CHART_COLOR)
+            if i % every == 0 or i == n - 1:
+                draw.text((px, CHART_H - CHART_PAD_B + 6), str(xs[i]), font=_FONT, fill=CHART_TEXT, anchor="mt")
+        return _img_png(img)
+
 # ---------------- UI (keyboards) ----------------
 def build_main_kb(bound:bool):
     kb = InlineKeyboardMarkup(inline_keyboard=[
@@ -340,10 +692,27 @@ def charts_kb():
     return kb
 
 # ---------------- Handlers ----------------
+# один колбэк на пользователя за раз: повторный тап, пока первый ещё обрабатывается
+# (OpenDota + рендер), сразу получает "⏳" и не запускает ту же работу второй раз
+CB_INFLIGHT_MAX = 30  # seconds, зависшая отметка дольше этого не блокирует
+_active_cb: Dict[int, float] = {}
+
+@dp.callback_query.outer_middleware()
+async def debounce_callbacks(handler, cq: CallbackQuery, data: Dict[str,Any]):
+    uid = cq.from_user.id; now = time.monotonic()
+    if uid in _active_cb and now - _active_cb[uid] < CB_INFLIGHT_MAX:
+        await cq.answer("⏳"); return None
+    _active_cb[uid] = now
+    try:
+        return await handler(cq, data)
+    finally:
+        # зависший обработчик, доработавший после CB_INFLIGHT_MAX, не снимает отметку нового
+        if _active_cb.get(uid) == now:
+            del _active_cb[uid]
+
 
 @dp.message(Command("start"))
 async def cmd_start(m: Message):
-    init_db()
     u = db_get_user(m.from_user.id)
     bound = bool(u and u.get("steam32"))
     await m.answer("Привет! Я Dota 2 трекер — привяжи Steam и пользуйся меню.", reply_markup=build_main_kb(bound))
@@ -353,53 +722,45 @@ async def cb_bind(cq: CallbackQuery):
     await cq.message.answer("Пришли Steam ID (steam32/steam64) или ссылку вида https://steamcommunity.com/profiles/7656...")
     await cq.answer()
 
-@dp.message()
-async def msg_handler(m: Message):
-    txt = (m.text or "").strip()
-    if not txt:
+def _looks_like_steam(text:str) -> bool:
+    t = text.strip()
+    return "steamcommunity.com" in t or t.isdigit()
+
+@dp.message(F.text.regexp(MMR_RE, mode="fullmatch").as_("mmr_match"))
+async def handle_mmr(m: Message, mmr_match: re.Match):
+    mmr_val = int(mmr_match.group(1))
+    if mmr_val <= 0 or mmr_val > 30000:
+        await m.reply("Неправильное значение MMR.")
         return
-    # mmr input flexible
-    mmr_match = re.match(r"^\s*mmr\s*[:=]?\s*(\d{2,5})\s*$", txt, re.I) or re.match(r"^\s*mmr(\d{2,5})\s*$", txt, re.I)
-    if mmr_match:
-        mmr_val = int(mmr_match.group(1))
-        if mmr_val <= 0 or mmr_val > 30000:
-            await m.reply("Неправильное значение MMR.")
-            return
-        init_db()
+    with db_tx():
         db_update_exact_mmr(m.from_user.id, mmr_val)
-        # update max mmr
-        u = db_get_user(m.from_user.id)
-        if u:
-            max_mm = u.get("max_mmr") or 0
-            if mmr_val > max_mm:
-                with closing(sqlite3.connect(DB_PATH)) as con:
-                    con.execute("UPDATE users SET max_mmr=? WHERE telegram_id=?", (mmr_val, m.from_user.id))
-                    con.commit()
-        await m.reply(f"✅ Точный MMR сохранён: {mmr_val}", reply_markup=build_main_kb(True))
+        db_update_max_mmr(m.from_user.id, mmr_val)
+    await m.reply(f"✅ Точный MMR сохранён: {mmr_val}", reply_markup=build_main_kb(True))
+
+@dp.message(F.text.func(_looks_like_steam))
+async def handle_bind(m: Message):
+    steam32 = parse_steam_any(m.text)
+    if steam32 is None:
+        await m.reply("Не удалось распознать Steam ID. Отправь /profiles/7656... или числовой steam64/steam32.")
         return
-
-    # steam binding
-    if "steamcommunity.com" in txt or txt.isdigit():
-        steam32 = parse_steam_any(txt)
-        if steam32 is None:
-            await m.reply("Не удалось распознать Steam ID. Отправь /profiles/7656... или числовой steam64/steam32.")
-            return
-        init_db()
-        # verify
-        pl = await od_player(steam32)
-        if not pl or not pl.get("profile"):
-            await m.reply("Профиль не найден в OpenDota. Убедись, что профиль доступен.")
-            return
+    # verify
+    pl = await od_player(steam32)
+    if not pl or not pl.get("profile"):
+        await m.reply("Профиль не найден в OpenDota. Убедись, что профиль доступен.")
+        return
+    rank_tier = pl.get("rank_tier")
+    est = approx_mmr_from_rank_tier(rank_tier)
+    _reset_poll_schedule(m.from_user.id)  # новый аккаунт — опросить в ближайший цикл
+    with db_tx():
         db_set_user_steam(m.from_user.id, steam32)
-        rank_tier = pl.get("rank_tier")
-        est = approx_mmr_from_rank_tier(rank_tier)
         if est:
             db_update_auto_mmr(m.from_user.id, est)
             db_set_last_rank_tier(m.from_user.id, rank_tier)
-        await m.reply(f"✅ Привязан Steam32: {steam32}", reply_markup=build_main_kb(True))
-        return
-
-    # else ignore
+    await m.reply(f"✅ Привязан Steam32: {steam32}", reply_markup=build_main_kb(True))
+    # история для локальной аналитики (герои, итоги дня) — одной транзакцией
+    if BACKFILL_LIMIT:
+        hist = await od_matches(steam32, limit=BACKFILL_LIMIT, params={"project": MATCH_FIELDS})
+        if hist: db_backfill_matches(str(steam32), hist)
 
 @dp.callback_query(F.data == "back_main")
 async def cb_back_main(cq: CallbackQuery):
@@ -415,20 +776,17 @@ async def cb_set_mmr(cq: CallbackQuery):
 
 @dp.callback_query(F.data == "status")
 async def cb_status(cq: CallbackQuery):
-    init_db()
     u = db_get_user(cq.from_user.id)
     if not u or not u.get("steam32"):
         await cq.message.answer("Сначала привяжи Steam.")
         await cq.answer(); return
     loading = await cq.message.answer("⏳ Загружаю статус...")
     steam32 = int(u["steam32"])
-    heroes_map_task = od_heroes_map()
-    gm_task = od_get("/constants/game_mode")
     player_task = od_player(steam32)
     recent_task = od_recent(steam32)
-    heroes_map, gm_map, player, recent = await asyncio.gather(heroes_map_task, gm_task, player_task, recent_task)
+    player, recent = await asyncio.gather(player_task, recent_task)
     rank_tier = player.get("rank_tier") if player else None
-    rank_str = ("—" if not rank_tier else ("Immortal" if rank_tier//10==8 else f"{['Herald','Guardian','Crusader','Archon','Legend','Ancient','Divine'][rank_tier//10 -1]} {rank_tier%10}"))
+    rank_str = ("—" if not rank_tier else (RANK_NAMES[7] if rank_tier//10==8 else f"{RANK_NAMES[rank_tier//10 -1]} {rank_tier%10}"))
     approx = approx_mmr_from_rank_tier(rank_tier)
     exact = u.get("exact_mmr")
     auto = u.get("current_mmr") or approx
@@ -437,7 +795,7 @@ async def cb_status(cq: CallbackQuery):
     last_info = "—"
     if recent and isinstance(recent, list) and len(recent)>0:
         r = recent[0]
-        gm_name = game_mode_name(r.get("game_mode",-1), gm_map or {})
+        gm_name = game_mode_name(r.get("game_mode",-1))
         ps = r.get("player_slot",0)
         win = "✅ Победа" if is_player_win(ps, bool(r.get("radiant_win"))) else "❌ Поражение"
         last_info = f"{ts_msk(r.get('start_time'))}\n{gm_name} | {win}\n{r.get('kills',0)}/{r.get('deaths',0)}/{r.get('assists',0)}\n<a href='{OPEN_DOTA}/matches/{r.get('match_id')}'>OpenDota</a>"
@@ -455,7 +813,6 @@ async def cb_status(cq: CallbackQuery):
 
 @dp.callback_query(F.data == "last_games")
 async def cb_last_games(cq: CallbackQuery):
-    init_db()
     u = db_get_user(cq.from_user.id)
     if not u or not u.get("steam32"):
         await cq.message.answer("Привяжи Steam сначала.")
@@ -465,23 +822,20 @@ async def cb_last_games(cq: CallbackQuery):
     recent = await od_recent(steam32) or []
     if not recent:
         await loading.edit_text("Нет последних матчей.", reply_markup=build_main_kb(True)); await cq.answer(); return
-    heroes_map = await od_heroes_map() or []
-    gm_map = await od_get("/constants/game_mode") or {}
     lines = ["<b>🎮 Последние 10 матчей (все режимы)</b>"]
+    deltas = await db_read(db_match_deltas, str(steam32), [m.get("match_id") for m in recent[:10] if m.get("lobby_type")==7])
     for i,m in enumerate(recent[:10],1):
-        gm = game_mode_name(m.get("game_mode",-1), gm_map)
-        hero = hero_name_from_map(m.get("hero_id"), heroes_map)
+        gm = game_mode_name(m.get("game_mode",-1))
+        hero = hero_name(m.get("hero_id"))
         ps = m.get("player_slot",0)
-        win = "✅" if is_player_win(ps, bool(m.get("radiant_win"))) else "❌"
-        kda = f"{m.get('kills',0)}/{m.get('deaths',0)}/{m.get('assists',0)} (KDA {safe_kda(m.get('kills',0),m.get('deaths',0),m.get('assists',0)):.2f})"
+        win = "✅" if (ps < 128) == bool(m.get("radiant_win")) else "❌"
+        k = m.get('kills') or 0; d = m.get('deaths') or 0; a = m.get('assists') or 0
+        kda = f"{k}/{d}/{a} (KDA {round((k+a)/(d or 1), 2):.2f})"
         ranked_str = ""
-        if m.get("lobby_type")==7:
-            with closing(sqlite3.connect(DB_PATH)) as con:
-                con.row_factory = sqlite3.Row
-                r = con.execute("SELECT delta_mmr, mmr_after FROM matches WHERE steam32=? AND match_id=?", (str(steam32), m.get("match_id"))).fetchone()
-                if r and r["delta_mmr"] is not None:
-                    arrow = "▲" if r["delta_mmr"]>0 else ("▼" if r["delta_mmr"]<0 else "•")
-                    ranked_str = f" | {arrow} {r['delta_mmr']:+d} (MMR {r['mmr_after']})"
+        delta, mmr_after = deltas.get(m.get("match_id"), (None, None))
+        if delta is not None:
+            arrow = "▲" if delta>0 else ("▼" if delta<0 else "•")
+            ranked_str = f" | {arrow} {delta:+d} (MMR {mmr_after})"
         lines.append(f"{i}) {ts_msk(m.get('start_time'))} — {hero} — {gm} — {win} — {kda}{ranked_str} — <a href='{OPEN_DOTA}/matches/{m.get('match_id')}'>match</a>")
     await loading.edit_text("\n".join(lines), disable_web_page_preview=True, reply_markup=build_main_kb(True))
     await cq.answer()
@@ -491,15 +845,21 @@ async def cb_heroes_menu(cq: CallbackQuery):
     await cq.message.answer("Выберите сортировку:", reply_markup=heroes_kb()); await cq.answer()
 
 async def render_heroes_sorted(steam32:int, sort_by:str):
-    heroes_map = await od_heroes_map() or []
+    min_games = 0 if sort_by=="games" else 10
+    agg = await db_read(db_hero_aggregates, str(steam32), sort_by, min_games, 15)
+    # пустой результат при min_games — ещё не повод уходить в OpenDota: все сортировки
+    # должны считаться по одним данным, поэтому fallback только без локальной истории
+    if agg or await db_read(db_has_matches, str(steam32)):
+        return [{"hero": hero_name(a["hero_id"]), "games": a["games"], "wr": a["wr"], "kda": round(a["kda"], 2)} for a in agg]
+    # локальной истории ещё нет — берём статистику OpenDota
     stats = await od_player_heroes(steam32) or []
     rows = []
     for s in stats:
         games = s.get("games",0)
         if games<=0: continue
         hid = s.get("hero_id")
-        k = s.get("k",0); d = s.get("d",0); a = s.get("a",0)
-        rows.append({"hero": hero_name_from_map(hid, heroes_map), "games":games, "wr": (s.get("win",0)/games*100) if games else 0.0, "kda": safe_kda(k,d,a)})
+        k = s.get("k") or 0; d = s.get("d") or 0; a = s.get("a") or 0
+        rows.append({"hero": hero_name(hid), "games":games, "wr": (s.get("win",0)/games*100) if games else 0.0, "kda": round((k+a)/(d or 1), 2)})
     if sort_by=="games":
         rows.sort(key=lambda x:x["games"], reverse=True)
     elif sort_by=="wr":
@@ -554,103 +914,84 @@ async def cb_heroes_analytics(cq: CallbackQuery):
         await cq.message.answer("Привяжи Steam."); await cq.answer(); return
     steam32 = int(u["steam32"])
     loading = await cq.message.answer("⏳ Анализирую...")
-    agg = db_hero_aggregates(str(steam32))
-    heroes_map = await od_heroes_map() or []
-    wrs = []
-    for a in agg:
-        g = a["games"]; w = a["wins"]
-        if g>=10:
-            wrs.append((a["hero_id"], g, w, (w/g)*100, a["avg_nw"]))
-    wrs.sort(key=lambda x:(x[3], x[1]), reverse=True)
+    # фильтр, сортировка и топ-10 — в SQL
+    top_wr, top_nw = await asyncio.gather(db_read(db_hero_aggregates, str(steam32), "wr", 10, 10),
+                                          db_read(db_hero_aggregates, str(steam32), "nw", 5, 10))
     text = ["🏅 <b>Топ героев по WR (>=10)</b>"]
-    for i,item in enumerate(wrs[:10],1):
-        hid,g,w,wrp,nw = item
-        text.append(f"{i}) {hero_name_from_map(hid, heroes_map)} — WR {wrp:.0f}% ({g} игр)")
-    nwlist = [ (a["hero_id"], a["games"], a["avg_nw"]) for a in agg if a["games"]>=5 ]
-    nwlist.sort(key=lambda x:x[2], reverse=True)
+    for i,a in enumerate(top_wr,1):
+        text.append(f"{i}) {hero_name(a['hero_id'])} — WR {a['wr']:.0f}% ({a['games']} игр)")
     text += ["", "💰 <b>Топ по среднему Net Worth (>=5)</b>"]
-    for i,item in enumerate(nwlist[:10],1):
-        hid,g,nw = item
-        text.append(f"{i}) {hero_name_from_map(hid, heroes_map)} — NW {nw:.0f} (игр: {g})")
+    for i,a in enumerate(top_nw,1):
+        text.append(f"{i}) {hero_name(a['hero_id'])} — NW {a['avg_nw']:.0f} (игр: {a['games']})")
     await loading.edit_text("\n".join(text), disable_web_page_preview=True, reply_markup=build_main_kb(True)); await cq.answer()
 
 @dp.callback_query(F.data == "activity")
 async def cb_activity(cq: CallbackQuery):
-    init_db()
     u = db_get_user(cq.from_user.id)
     if not u or not u.get("steam32"):
         await cq.message.answer("Привяжи Steam."); await cq.answer(); return
     steam32 = int(u["steam32"])
     loading = await cq.message.answer("⏳ Формирую активность (7 дней)...")
     recent = await od_recent(steam32) or []
-    today_msk = (datetime.utcnow() + timedelta(hours=MSK_OFFSET)).date()
-    days = [(today_msk - timedelta(days=i)) for i in range(6,-1,-1)]
-    counts = {d:0 for d in days}
-    for m in recent:
-        ts = datetime.utcfromtimestamp(m.get("start_time",0)) + timedelta(hours=MSK_OFFSET)
-        d = ts.date()
-        if d in counts: counts[d] += 1
-    xs = [d.strftime("%d.%m") for d in days]
-    ys = [counts[d] for d in days]
-    fig, ax = plt.subplots(figsize=(7,3))
-    ax.bar(xs, ys)
-    ax.set_title("Активность (последние 7 дней)")
-    ax.set_xlabel("День"); ax.set_ylabel("Игры")
-    ax.grid(axis='y', alpha=0.3)
-    tmpf = tempfile.gettempdir() + f"/activity_{cq.from_user.id}.png"
-    fig.savefig(tmpf, bbox_inches='tight'); plt.close(fig)
+    shift = MSK_OFFSET_S
+    today_day = (msk_today_midnight_ts() + shift) // 86400
+    # номер дня (МСК) для каждого матча -> смещение от сегодня -> bincount по 7 корзинам
+    ts_arr = np.fromiter((m.get("start_time") or 0 for m in recent), dtype=np.int64, count=len(recent))
+    offsets = today_day - (ts_arr + shift) // 86400
+    offsets = offsets[(offsets >= 0) & (offsets <= 6)]
+    xs = [time.strftime("%d.%m", time.gmtime((today_day - i) * 86400)) for i in range(6,-1,-1)]
+    ys = np.bincount(6 - offsets, minlength=7).tolist()
+    key = f"{steam32}:act:{today_day}"; sig = (tuple(xs), tuple(ys))
+    png = chart_cache_get(key, sig)
+    if png is None:
+        png = await asyncio.to_thread(_render_activity_png, xs, ys)
+        chart_cache_put(key, sig, png)
     total = sum(ys); avg = total/7.0
     cap = f"📈 Активность за 7 дн.\n• Всего: {total}\n• Средн./день: {avg:.1f}"
-    await bot.send_photo(cq.from_user.id, FSInputFile(tmpf), caption=cap)
-    try: os.remove(tmpf)
-    except: pass
+    await bot.send_photo(cq.from_user.id, BufferedInputFile(png, filename="activity.png"), caption=cap)
     await loading.delete(); await cq.answer()
 
 @dp.callback_query(F.data == "mmr_trend")
 async def cb_mmr_trend(cq: CallbackQuery):
-    init_db()
     u = db_get_user(cq.from_user.id)
     if not u or not u.get("steam32"):
         await cq.message.answer("Привяжи Steam."); await cq.answer(); return
     steam32 = int(u["steam32"])
     loading = await cq.message.answer("⏳ Строю тренд MMR...")
-    matches = await od_matches(steam32, limit=60) or []
-    ranked = [m for m in matches if m.get("lobby_type")==7]
-    ranked = ranked[::-1]
+    # фильтр по ранкед делает OpenDota: 60 ранкед-матчей вместо 60 любых
+    ranked = (await od_matches(steam32, limit=60, params={"lobby_type": 7, "project": TREND_FIELDS}) or [])[::-1]
     if not ranked:
         await loading.edit_text("Мало ранк-матчей для тренда.", reply_markup=build_main_kb(True)); await cq.answer(); return
     exact = u.get("exact_mmr")
     if exact is not None:
         cur = exact
     else:
-        cur = u.get("current_mmr") or approx_mmr_from_rank_tier((await od_player(int(u["steam32"]))).get("rank_tier") if await od_player(int(u["steam32"])) else 0) or 0
+        cur = u.get("current_mmr")
+        if not cur:
+            pl = await od_player(steam32)
+            cur = approx_mmr_from_rank_tier(pl.get("rank_tier") if pl else None) or 0
     xs=[]; ys=[]
     tmp=cur
     for m in ranked:
-        win = is_player_win(m.get("player_slot",0), bool(m.get("radiant_win")))
+        win = (m.get("player_slot",0) < 128) == bool(m.get("radiant_win"))
         delta = ASSUMED_MMR_DELTA if win else -ASSUMED_MMR_DELTA
         tmp = tmp + delta
         xs.append(len(xs)+1); ys.append(tmp)
-    fig, ax = plt.subplots(figsize=(7,3))
-    ax.plot(xs, ys, marker='o')
-    ax.set_title("Тренд условного MMR (последние ранк)")
-    ax.set_xlabel("Матч"); ax.set_ylabel("MMR")
-    ax.grid(alpha=0.3)
-    tmpf = tempfile.gettempdir() + f"/mmr_{cq.from_user.id}.png"
-    fig.savefig(tmpf, bbox_inches='tight'); plt.close(fig)
+    key = f"{steam32}:mmr:{datetime.now(timezone.utc).date().isoformat()}"; sig = tuple(ys)
+    png = chart_cache_get(key, sig)
+    if png is None:
+        png = await asyncio.to_thread(_render_mmr_png, xs, ys)
+        chart_cache_put(key, sig, png)
     cap = f"📉 Тренд MMR (старт: {cur})"
-    await bot.send_photo(cq.from_user.id, FSInputFile(tmpf), caption=cap)
-    try: os.remove(tmpf)
-    except: pass
+    await bot.send_photo(cq.from_user.id, BufferedInputFile(png, filename="mmr.png"), caption=cap)
     await loading.delete(); await cq.answer()
 
 @dp.callback_query(F.data == "role_wr")
 async def cb_role_wr(cq: CallbackQuery):
-    init_db()
     u = db_get_user(cq.from_user.id)
     if not u or not u.get("steam32"):
         await cq.message.answer("Привяжи Steam."); await cq.answer(); return
-    stats = db_role_wr(str(u["steam32"]))
+    stats = await db_read(db_role_wr, str(u["steam32"]))
     core = stats["core"]; sup = stats["support"]
     core_wr = round(100*core["w"]/core["g"]) if core["g"] else 0
     sup_wr  = round(100*sup["w"]/sup["g"]) if sup["g"] else 0
@@ -658,107 +999,238 @@ async def cb_role_wr(cq: CallbackQuery):
     await cq.message.answer(text, parse_mode="HTML"); await cq.answer()
 
 # ---------------- Background tasks ----------------
-async def send_match_card(to_tg:int, heroes_map:List[dict], m:dict, mmr_after:Optional[int], delta:Optional[int]):
-    hero = hero_name_from_map(m.get("hero_id"), heroes_map)
+class RateLimiter:
+    # скользящее окно: не больше rate входов за per секунд, остальные ждут своей очереди
+    def __init__(self, rate:int, per:float=1.0):
+        self.rate, self.per = rate, per
+        self._stamps: deque = deque()
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                while self._stamps and now - self._stamps[0] >= self.per:
+                    self._stamps.popleft()
+                if len(self._stamps) < self.rate: break
+                await asyncio.sleep(self._stamps[0] + self.per - now)
+            self._stamps.append(now)
+
+    async def __aexit__(self, *exc):
+        return False
+
+_send_sem = asyncio.Semaphore(SEND_CONCURRENCY)
+_send_limiter = RateLimiter(SEND_RATE)
+
+async def send_text(to_tg:int, text:str, **kw) -> bool:
+    async with _send_sem:
+        for attempt in range(2):
+            try:
+                async with _send_limiter:
+                    await bot.send_message(to_tg, text, parse_mode="HTML", **kw)
+                return True
+            except TelegramRetryAfter as e:
+                # 429: Telegram сам говорит, сколько ждать — ждём и пробуем ещё раз
+                if attempt: logger.warning("Rate limited twice sending to %s", to_tg); return False
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                logger.exception("Failed to send message to %s: %s", to_tg, e)
+                return False
+        return False
+
+# статический текст карточки собирается один раз при импорте
+CARD_SEP = "━" * 20
+CARD_HDR = "🎮 <b>Новая игра</b>\n" + CARD_SEP + "\n"
+CARD_FTR = "\n" + CARD_SEP
+MATCH_CARD_TEMPLATE = (CARD_HDR + "📅 {when}\n🧩 {mode}\n🧙 Герой: <b>{hero}</b>\n"
+                       "⚔️ {k}/{d}/{a} (KDA {kda:.2f}) • ⏱ {dur}\n🏆 Итог: {res}{mmr_line}{banner}" + CARD_FTR)
+MATCH_URL_FMT = OPEN_DOTA + "/matches/{}"
+
+async def send_match_card(to_tg:int, m:dict, mmr_after:Optional[int], delta:Optional[int], streak_banner:str=""):
+    k, d, a = m.get("kills",0), m.get("deaths",0), m.get("assists",0)
     win = is_player_win(m.get("player_slot",0), bool(m.get("radiant_win")))
-    res = "✅ Победа" if win else "❌ Поражение"
-    kdastr = f"{m.get('kills',0)}/{m.get('deaths',0)}/{m.get('assists',0)} (KDA {safe_kda(m.get('kills',0),m.get('deaths',0),m.get('assists',0)):.2f})"
-    when = ts_msk(m.get("start_time",0))
-    dur = fmt_duration(m.get("duration",0))
-    mode_text = f"{lobby_name(m.get('lobby_type'))} | game_mode:{m.get('game_mode')}"
     mmr_line = ""
     if m.get("lobby_type")==7 and mmr_after is not None and delta is not None:
         arrow = "▲" if delta>0 else ("▼" if delta<0 else "•")
         mmr_line = f"\n📈 ΔMMR: {arrow} {delta:+d}\n📊 Текущий: <b>{mmr_after}</b>"
-    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton("Открыть в OpenDota", url=f"{OPEN_DOTA}/matches/{m.get('match_id')}")]])
-    text = (f"🎮 <b>Новая игра</b>\n━━━━━━━━━━━━━━━━━━━━\n📅 {when}\n🧩 {mode_text}\n🧙 Герой: <b>{hero}</b>\n⚔️ {kdastr} • ⏱ {dur}\n🏆 Итог: {res}{mmr_line}\n━━━━━━━━━━━━━━━━━━━━")
-    try:
-        await bot.send_message(to_tg, text, parse_mode="HTML", reply_markup=kb)
-    except Exception as e:
-        logger.exception("Failed to send match card to %s: %s", to_tg, e)
+    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="Открыть в OpenDota", url=MATCH_URL_FMT.format(m.get("match_id")))]])
+    text = MATCH_CARD_TEMPLATE.format(
+        when=ts_msk(m.get("start_time",0)), mode=f"{lobby_name(m.get('lobby_type'))} | game_mode:{m.get('game_mode')}",
+        hero=hero_name(m.get("hero_id")), k=k, d=d, a=a, kda=safe_kda(k, d, a), dur=fmt_duration(m.get("duration",0)),
+        res="✅ Победа" if win else "❌ Поражение", mmr_line=mmr_line,
+        banner=f"\n{streak_banner}" if streak_banner else "")
+    await send_text(to_tg, text, reply_markup=kb)
+
+_STREAK_SQL = "SELECT won FROM matches WHERE steam32=? ORDER BY start_time DESC LIMIT 50"
 
 def calc_streak_for_user(steam32:str) -> int:
-    with closing(sqlite3.connect(DB_PATH)) as con:
-        con.row_factory = sqlite3.Row
-        rs = con.execute("SELECT radiant_win, player_slot FROM matches WHERE steam32=? ORDER BY start_time DESC LIMIT 50", (steam32,)).fetchall()
+    rs = _CON.execute(_STREAK_SQL, (steam32,)).fetchall()
     if not rs: return 0
-    streak=0; last_win=None
-    for r in rs:
-        win = ((r["player_slot"]<128) and (r["radiant_win"]==1)) or ((r["player_slot"]>=128) and (r["radiant_win"]==0))
-        if last_win is None:
-            last_win = win; streak=1
-        elif win==last_win:
-            streak +=1
-        else:
-            break
-    return streak if last_win else -streak if streak else 0
+    # серия = длина префикса, равного самому свежему результату
+    wins = np.fromiter((bool(r[0]) for r in rs), dtype=bool, count=len(rs))
+    last_win = bool(wins[0]); diff = wins != wins[0]
+    streak = int(np.argmax(diff)) if diff.any() else len(wins)
+    return streak if last_win else -streak
+
+# кто давно не играл — опрашивается реже: (простой в секундах, множитель POLL_INTERVAL)
+POLL_IDLE_BACKOFF = ((24*3600, 10), (6*3600, 3))
+_next_poll_at: Dict[int, float] = {}  # tg -> monotonic-время, раньше которого не опрашиваем
+_poll_interval: Dict[int, float] = {}  # tg -> интервал: x1.5 за каждый опрос без нового матча, сброс на новом
+
+def _schedule_next_poll(tg:int, last_start:Optional[int], changed:bool):
+    iv = POLL_INTERVAL if changed else min(_poll_interval.get(tg, POLL_INTERVAL) * 1.5, POLL_BACKOFF_MAX)
+    _poll_interval[tg] = iv
+    idle = time.time() - (last_start or 0)
+    k = next((k for t,k in POLL_IDLE_BACKOFF if idle > t), 1)
+    _next_poll_at[tg] = time.monotonic() + max(iv, k * POLL_INTERVAL)
+
+def _reset_poll_schedule(tg:int):
+    _next_poll_at.pop(tg, None); _poll_interval.pop(tg, None)
+
+async def poll_user(u:Dict[str,Any], sem:asyncio.Semaphore) -> Optional[Dict[str,Any]]:
+    # только сеть и расчёты; запись в БД — одной транзакцией на весь цикл (poll_cycle)
+    await asyncio.sleep(random.random() * POLL_JITTER)
+    async with sem:
+        try:
+            tg = u["telegram_id"]
+            steam32 = u["steam32_int"]
+            _next_poll_at[tg] = time.monotonic() + POLL_INTERVAL  # если запрос упадёт
+            # один запрос на последние матчи: из него же берём последний ранкед
+            matches = await od_matches(steam32, limit=20, params={"project": MATCH_FIELDS})
+            if not matches: return None
+            m = matches[0]
+            changed = u.get("last_any_match") != m.get("match_id")
+            _schedule_next_poll(tg, m.get("start_time"), changed)
+            ranked_m = next((x for x in matches if x.get("lobby_type")==7), None)
+            ranked_changed = ranked_m is not None and u.get("last_ranked_match") != ranked_m.get("match_id")
+            # ничего нового: ни деталей матча, ни записей в БД, ни пересчёта серии
+            if not changed and not ranked_changed: return None
+            # MMR и строку матча считаем уже в транзакции (db_apply_poll_results): между этим
+            # местом и записью есть await, за это время пользователь мог сменить mmr или аккаунт
+            res = {"tg": tg, "steam32": u["steam32"], "new": None, "row": None, "ranked_id": None, "missed": []}
+            if changed:
+                # за один опрос могло прийти несколько игр (лаг OpenDota, пауза, редкий опрос):
+                # более старые пишем как есть, полная обработка — только у самой свежей
+                last_id = u.get("last_any_match") or 0
+                res["missed"] = [x for x in matches[1:] if (x.get("match_id") or 0) > last_id]
+                nw=None; gpm=None; role=None
+                detail = None
+                if m.get("lobby_type")==7 or DETAIL_FOR_UNRANKED:
+                    detail = await get_match_detail(m.get("match_id")); role = "core"
+                if detail and "players" in detail:
+                    for p in detail["players"]:
+                        if p.get("account_id")==steam32:
+                            nw = p.get("net_worth"); gpm = p.get("gold_per_min")
+                            purchases = (it.get("key","") for it in p.get("purchase_log") or ())
+                            role = guess_role_from_purchase_and_gpm(purchases, gpm or 0)
+                            break
+                res["new"] = (m, nw, gpm, role)
+            if ranked_changed:
+                res["ranked_id"] = ranked_m.get("match_id")
+            return res if res["new"] or res["ranked_id"] else None
+        except Exception as e:
+            logger.exception("Error in poll_worker for user %s: %s", u, e)
+            return None
+
+def _next_streak(tg:int, steam32:str, won:bool, recount:bool=False) -> int:
+    # серия продлевается на один матч; NULL (после привязки/миграции) или
+    # несколько игр за опрос (recount) — разовый пересчёт по истории
+    prev = (db_get_user(tg) or {}).get("streak")
+    if prev is None or recount:
+        streak = calc_streak_for_user(steam32)
+    elif (prev > 0) == won:
+        streak = prev + (1 if won else -1)
+    else:
+        streak = 1 if won else -1
+    db_set_streak(tg, streak)
+    return streak
+
+def _ranked_mmr(dbu:Dict[str,Any], m:dict) -> Tuple[bool, Optional[int], Optional[int]]:
+    # (has_exact, delta, mmr_after) от MMR, который лежит в users прямо сейчас
+    has_exact = dbu.get("exact_mmr") is not None
+    effective = dbu.get("exact_mmr") if has_exact else dbu.get("current_mmr")
+    if m.get("lobby_type") != 7 or not isinstance(effective, int):
+        return has_exact, None, None
+    delta = ASSUMED_MMR_DELTA if is_player_win(m.get("player_slot",0), bool(m.get("radiant_win"))) else -ASSUMED_MMR_DELTA
+    return has_exact, delta, effective + delta
+
+def db_apply_poll_results(results:List[Dict[str,Any]]) -> List[Dict[str,Any]]:
+    with db_tx():
+        # перечитываем users внутри транзакции: без await между чтением и записью
+        live = []
+        for r in results:
+            dbu = db_get_user(r["tg"])
+            if dbu and dbu.get("steam32") == r["steam32"]:  # иначе аккаунт перепривязали во время опроса
+                r["dbu"] = dbu; live.append(r)
+        _CON.executemany(_BACKFILL_MATCH_SQL, [_match_row(r["steam32"], x, None, None, None, None) for r in live for x in r["missed"]])
+        for r in live:
+            if r["new"]:
+                m, nw, gpm, role = r["new"]
+                r["has_exact"], delta, mmr_after = _ranked_mmr(r["dbu"], m)
+                r["row"] = (m, nw, gpm, delta, mmr_after, role)
+        _CON.executemany(_UPSERT_MATCH_SQL, [_match_row(r["steam32"], *r["row"]) for r in live if r["row"]])
+        for r in live:
+            any_id = None
+            if r["row"]:
+                m, mmr_after = r["row"][0], r["row"][4]
+                any_id = m.get("match_id")
+                if mmr_after is not None:
+                    (db_update_exact_mmr if r["has_exact"] else db_update_auto_mmr)(r["tg"], mmr_after)
+                r["streak"] = _next_streak(r["tg"], r["steam32"], is_player_win(m.get("player_slot",0), bool(m.get("radiant_win"))), recount=bool(r["missed"]))
+            db_set_last_ids(r["tg"], any_id=any_id, ranked_id=r["ranked_id"])
+    return live
+
+async def notify_new_match(r:Dict[str,Any]):
+    m, _, _, delta, mmr_after, _ = r["row"]
+    streak = r["streak"]
+    # баннер серии — внутри карточки, одним сообщением
+    banner = ""
+    if streak >= STREAK_NOTIFY_WIN:
+        banner = f"🔥 Винстрик: {streak} побед подряд!"
+    elif streak <= -STREAK_NOTIFY_LOSE:
+        banner = f"💀 Лузстрик: {-streak} поражений подряд."
+    await send_match_card(r["tg"], m, mmr_after, delta, streak_banner=banner)
+
+def _log_failures(what:str, keys:List[Any], outcomes:List[Any]):
+    # gather(return_exceptions=True) глотает ошибки — без этого падение карточки не видно в логе
+    for key, out in zip(keys, outcomes):
+        if isinstance(out, BaseException):
+            logger.error("%s failed for %s", what, key, exc_info=out)
+
+async def poll_cycle(users:List[Dict[str,Any]], sem:asyncio.Semaphore):
+    outcomes = await asyncio.gather(*(poll_user(u, sem) for u in users), return_exceptions=True)
+    _log_failures("poll_user", [u["telegram_id"] for u in users], outcomes)
+    results = [r for r in outcomes if isinstance(r, dict)]
+    if not results: return
+    fresh = [r for r in db_apply_poll_results(results) if r["row"]]
+    outcomes = await asyncio.gather(*(notify_new_match(r) for r in fresh), return_exceptions=True)
+    _log_failures("notify_new_match", [r["tg"] for r in fresh], outcomes)
 
 async def poll_worker():
-    init_db()
     await asyncio.sleep(3)
+    last_optimize = time.monotonic()
+    sem = asyncio.Semaphore(POLL_CONCURRENCY)
     while True:
         try:
-            users = db_get_all_users_with_steam()
-            if not users:
-                await asyncio.sleep(POLL_INTERVAL); continue
-            heroes_map = await od_heroes_map() or []
-            for u in users:
-                try:
-                    tg = u["telegram_id"]
-                    steam32 = int(u["steam32"])
-                    matches = await od_matches(steam32, limit=1)
-                    if not matches: continue
-                    m = matches[0]
-                    if u.get("last_any_match") != m.get("match_id"):
-                        detail = await od_match_detail(m.get("match_id"))
-                        nw=None; gpm=None; role="core"
-                        if detail and "players" in detail:
-                            for p in detail["players"]:
-                                if p.get("account_id")==steam32:
-                                    nw = p.get("net_worth"); gpm = p.get("gold_per_min")
-                                    purchases = [it.get("key","") for it in p.get("purchase_log",[])]
-                                    role = guess_role_from_purchase_and_gpm(purchases, gpm or 0)
-                                    break
-                        delta=None; mmr_after=None
-                        if m.get("lobby_type")==7:
-                            dbu = db_get_user(tg)
-                            effective = dbu.get("exact_mmr") if dbu.get("exact_mmr") is not None else dbu.get("current_mmr")
-                            if isinstance(effective,int):
-                                win = is_player_win(m.get("player_slot",0), bool(m.get("radiant_win")))
-                                delta = ASSUMED_MMR_DELTA if win else -ASSUMED_MMR_DELTA
-                                mmr_after = effective + delta
-                                if dbu.get("exact_mmr") is not None:
-                                    db_update_exact_mmr(tg, mmr_after)
-                                else:
-                                    db_update_auto_mmr(tg, mmr_after)
-                        db_upsert_match(str(steam32), m, nw, gpm, delta, mmr_after)
-                        db_set_last_ids(tg, any_id=m.get("match_id"))
-                        await send_match_card(tg, heroes_map, m, mmr_after, delta)
-                        streak = calc_streak_for_user(str(steam32))
-                        if streak >= STREAK_NOTIFY_WIN:
-                            await bot.send_message(tg, f"🔥 Винстрик: {streak} побед подряд!")
-                        if streak <= -STREAK_NOTIFY_LOSE:
-                            await bot.send_message(tg, f"💀 Лузстрик: {-streak} поражений подряд.")
-                    # ranked last id update
-                    ranked_m = await od_matches(steam32, limit=1, params={"lobby_type":7})
-                    if ranked_m:
-                        rid = ranked_m[0].get("match_id")
-                        if u.get("last_ranked_match") != rid:
-                            db_set_last_ids(tg, ranked_id=rid)
-                except Exception as e:
-                    logger.exception("Error in poll_worker for user %s: %s", u, e)
-            await asyncio.sleep(POLL_INTERVAL)
+            if time.monotonic() - last_optimize >= DB_OPTIMIZE_EVERY:
+                db_optimize(); last_optimize = time.monotonic()
+            now = time.monotonic()
+            if od_circuit_open():
+                await asyncio.sleep(_od_open_until - now)
+                continue
+            users = [u for u in db_get_all_users_with_steam() if _next_poll_at.get(u["telegram_id"], 0) <= now]
+            if users:
+                await poll_cycle(users, sem)
+            # до ближайшего запланированного опроса, но не дольше POLL_INTERVAL — вдруг привязался новый
+            wait = min(_next_poll_at.values(), default=now + POLL_INTERVAL) - time.monotonic()
+            await asyncio.sleep(min(max(wait, 1), POLL_INTERVAL))
         except Exception as e:
             logger.exception("poll_worker crashed: %s", e)
             await asyncio.sleep(10)
 
 def seconds_until_daily():
-    now_utc = datetime.now(timezone.utc)
-    now_msk = now_utc + timedelta(hours=MSK_OFFSET)
-    target = now_msk.replace(hour=DAILY_REPORT_HOUR, minute=DAILY_REPORT_MINUTE, second=0, microsecond=0)
-    if target <= now_msk:
-        target += timedelta(days=1)
-    return int((target - now_msk).total_seconds())
+    wait = DAILY_REPORT_HOUR*3600 + DAILY_REPORT_MINUTE*60 - (int(time.time()) + MSK_OFFSET_S) % 86400
+    return wait if wait > 0 else wait + 86400
 
 async def daily_worker():
     await asyncio.sleep(5)
@@ -770,21 +1242,17 @@ async def daily_worker():
             users = db_get_all_users_with_steam()
             if not users:
                 continue
-            now_utc = datetime.now(timezone.utc)
-            now_msk = now_utc + timedelta(hours=MSK_OFFSET)
-            start_msk = now_msk.replace(hour=0, minute=0, second=0, microsecond=0)
-            start_utc = start_msk - timedelta(hours=MSK_OFFSET)
-            start_ts = int(start_utc.timestamp())
-            end_ts = int(now_utc.timestamp())
+            start_ts = msk_today_midnight_ts()
+            end_ts = int(time.time())
+            stats = await db_read(db_daily_stats, start_ts, end_ts)
+            outbox = []
             for u in users:
                 try:
-                    steam32 = u["steam32"]; tg = u["telegram_id"]
-                    arr = await od_matches(int(steam32), limit=200) or []
-                    today = [m for m in arr if start_ts <= m.get("start_time",0) <= end_ts]
-                    games = len(today); wins = sum(1 for m in today if is_player_win(m.get("player_slot",0), bool(m.get("radiant_win"))))
+                    tg = u["telegram_id"]
+                    st = stats.get(u["steam32"]) or {"g": 0, "w": 0, "dm": 0}
+                    games = st["g"]; wins = st["w"]; dm = st["dm"]
                     loses = games - wins
                     wr = round(100*wins/games) if games else 0
-                    dm = db_sum_delta_mmr_today(str(steam32), start_ts, end_ts)
                     eff = (u.get("exact_mmr") if u.get("exact_mmr") is not None else u.get("current_mmr"))
                     text = ("📊 <b>Итоги дня</b>\n"
                             f"• Игр: <b>{games}</b>\n"
@@ -793,9 +1261,11 @@ async def daily_worker():
                             f"• Текущий рейтинг: <b>{eff if eff is not None else '—'}</b>\n")
                     if games == 0:
                         text += "\n• Сегодня ты не играл — удачи завтра! ✨"
-                    await bot.send_message(tg, text, parse_mode="HTML")
+                    outbox.append(send_text(tg, text))
                 except Exception as e:
                     logger.exception("daily_worker user failure: %s", e)
+            # рассылка параллельно; темп держит _send_limiter (SEND_RATE в секунду)
+            await asyncio.gather(*outbox)
         except Exception as e:
             logger.exception("daily_worker crashed: %s", e)
             await asyncio.sleep(30)
@@ -803,11 +1273,18 @@ async def daily_worker():
 # ---------------- Startup ----------------
 async def main():
     init_db()
+    od_session()
+    await load_constants()
     logger.info("Starting background tasks")
+    asyncio.create_task(constants_worker())
     asyncio.create_task(poll_worker())
     asyncio.create_task(daily_worker())
     logger.info("Starting polling")
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        if _SESSION is not None:
+            await _SESSION.close()
 
 if __name__ == "__main__":
     try: